@@ -1,14 +1,23 @@
 # app.py - 最終完成版 (1行40枚グリッドレイアウト対応)
 
 import math
+import os
 import shutil
-from io import BytesIO
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 
 import cv2
+import numpy as np
 import streamlit as st
 import yt_dlp
-from PIL import Image
+
+# ダウンロードした動画の保存先 (キャプチャ枚数を変えた再作成で使い回し、VIDEO_CACHE_TTL_SECONDS経過後に削除する)
+VIDEO_CACHE_DIR = Path("./temp_video_for_webapp")
+VIDEO_CACHE_TTL_SECONDS = 60 * 60
+# 完成したコンタクトシート (JPEG) をキャッシュしておく期間
+SHEET_CACHE_TTL_SECONDS = 60 * 60
 
 
 def download_video_with_library(url, temp_dir):
@@ -17,18 +26,18 @@ def download_video_with_library(url, temp_dir):
         ydl_opts = {
             'outtmpl': str(temp_dir / '%(id)s.%(ext)s'),
             'restrictfilenames': True,
-            'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+            # コンタクトシートに音声は不要なので、映像ストリームだけを取得して結合処理を省く
+            'format': 'bestvideo[ext=mp4]/best[ext=mp4]/best',
+            # タイルは幅240pxまで縮小するので、540p以下で最大の解像度を優先してデコード量を減らす
+            'format_sort': ['res:540'],
         }
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            st.info("動画情報を取得しています...")
-            info = ydl.extract_info(url, download=False)
+            st.info("動画情報を取得して、ダウンロードを開始します...")
+            # 情報取得とダウンロードを1回の呼び出しで行い、ページの再取得を避ける
+            info = ydl.extract_info(url, download=True)
             video_id = info.get('id', 'unknown_id')
-            ext = info.get('ext', 'mp4')
-            filename = f"{video_id}.{ext}"
-            output_path = temp_dir / filename
-            st.info(f"動画ファイル「{filename}」のダウンロードを開始します...")
-            ydl.download([url])
-            st.info("ダウンロードが完了しました。")
+            output_path = Path(ydl.prepare_filename(info))
+            st.info(f"動画ファイル「{output_path.name}」のダウンロードが完了しました。")
         return output_path, video_id
     except yt_dlp.utils.DownloadError:
         st.error("動画のダウンロードに失敗しました。URLがサポートされていないか、動画が非公開の可能性があります。")
@@ -38,9 +47,20 @@ def download_video_with_library(url, temp_dir):
         return None, None
 
 
+def resize_frame(frame, target_size, out):
+    """BGRフレームを(幅, 高さ)に縮小し、キャンバス上のタイル領域outへ直接書き込む (色変換は行わない)"""
+    cv2.resize(frame, target_size, dst=out, interpolation=cv2.INTER_AREA)
+
+
 def create_contact_sheet_image(video_path, capture_per_second, progress_bar):
     """動画から画像を抽出し、リサイズしてグリッド状のコンタクトシートを作成する"""
-    cap = cv2.VideoCapture(str(video_path))
+    # バックエンドの自動選択を省き、libavを直接使うFFmpegバックエンドで開く
+    # GPU (NVDEC / VideoToolbox など) のデコーダが使える環境ではH.264のデコードをそちらに任せる
+    hw_params = [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+    cap = cv2.VideoCapture(str(video_path), cv2.CAP_FFMPEG, hw_params)
+    if not cap.isOpened():
+        # ハードウェアデコードの初期化に失敗した場合はCPUデコードで開き直す
+        cap = cv2.VideoCapture(str(video_path), cv2.CAP_FFMPEG)
     if not cap.isOpened():
         st.error("エラー: 動画ファイルを開けませんでした。")
         return None, 0
@@ -51,56 +71,171 @@ def create_contact_sheet_image(video_path, capture_per_second, progress_bar):
         st.error("エラー: 動画のFPSが取得できませんでした。")
         return None, 0
 
+    video_width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+    video_height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    if video_width == 0 or video_height == 0:
+        st.error("エラー: 動画の解像度が取得できませんでした。")
+        return None, 0
+
     capture_interval = math.floor(video_fps / capture_per_second)
     if capture_interval == 0:
         capture_interval = 1
 
-    images = []
-    frame_count = 0
+    # ★★★ ご希望の「1行40枚」設定 ★★★
+    IMAGES_PER_ROW = 40
     RESIZED_WIDTH = 240
+    PROGRESS_UPDATES = 50
+    MAX_TILES = 2000
+
+    # 長い動画でタイルが増えすぎるとキャンバスがメモリに収まらないため、キャプチャ間隔を広げて上限内に収める
+    if frame_total > 0 and math.ceil(frame_total / capture_interval) > MAX_TILES:
+        capture_interval = math.ceil(frame_total / MAX_TILES)
+        st.info(
+            f"動画が長いため、キャプチャ間隔を{capture_interval}フレームごと"
+            f" (1秒あたり約{video_fps / capture_interval:.2f}枚) に調整しました。"
+        )
+
+    # 解像度は全フレーム共通なので、縮小後のサイズはループ前に1度だけ求める
+    img_width = RESIZED_WIDTH
+    img_height = int(RESIZED_WIDTH * video_height / video_width)
+    target_size = (img_width, img_height)
+
+    # キャプチャ枚数の見込みからキャンバスを先に確保し、各タイルは縮小時にその位置へ直接書き込む (余白は黒)
+    estimated_images = math.ceil(frame_total / capture_interval) if frame_total > 0 else 0
+    max_canvas_rows = math.ceil(MAX_TILES / IMAGES_PER_ROW)
+    canvas_rows = min(max(1, math.ceil(estimated_images / IMAGES_PER_ROW)), max_canvas_rows)
+    canvas = np.zeros((canvas_rows * img_height, IMAGES_PER_ROW * img_width, 3), dtype=np.uint8)
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        if frame_count % capture_interval == 0:
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            pil_image = Image.fromarray(rgb_frame)
-            width, height = pil_image.size
-            aspect_ratio = height / width
-            new_height = int(RESIZED_WIDTH * aspect_ratio)
-            resized_image = pil_image.resize((RESIZED_WIDTH, new_height), Image.Resampling.LANCZOS)
-            images.append(resized_image)
-        frame_count += 1
-        if frame_total > 0:
-            progress_bar.progress(frame_count / frame_total, text="フレームを抽出中...")
+    max_workers = os.cpu_count() or 1
+    futures = []
+    pending = set()  # 縮小が終わっていないタイル
+    num_images = 0
+    frame_count = 0
+    next_sample = 0  # 次にキャプチャするフレーム番号
+    progress_step = max(1, frame_total // PROGRESS_UPDATES)
+    next_progress = progress_step
+
+    # 縮小はGILを解放するので、デコードを続けながら別スレッドで並列に処理する
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            # 間隔は最大でも1秒分で、POS_FRAMESのシークは直前のキーフレームからデコードし直すため、シークせず順に読み進める
+            # grab()はデコードまで行う。色変換 (YUV→BGR) とコピーはretrieve()で行うため、間引くフレームではそれを省ける
+            ret = cap.grab()
+            if not ret:
+                break
+            if frame_count == next_sample:
+                if num_images == MAX_TILES:
+                    # フレーム数の情報が不正確な動画でも上限を超えないようにする
+                    st.warning(
+                        f"警告: タイル数が上限の{MAX_TILES}枚に達したため、"
+                        f"動画の約{frame_count / video_fps:.1f}秒の時点でコンタクトシートを打ち切りました。"
+                    )
+                    break
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+                row_index, col_index = divmod(num_images, IMAGES_PER_ROW)
+                if row_index == canvas_rows:
+                    # フレーム数の情報が実際より少なかった場合は、書き込み中のタイルを待ってから行数を倍にする
+                    # (MAX_TILES分の行数を超えては確保しない)
+                    wait(pending)
+                    new_rows = min(canvas_rows * 2, max_canvas_rows)
+                    extra_rows = np.zeros(((new_rows - canvas_rows) * img_height, *canvas.shape[1:]), dtype=np.uint8)
+                    canvas = np.concatenate([canvas, extra_rows])
+                    canvas_rows = new_rows
+                y = row_index * img_height
+                x = col_index * img_width
+                tile = canvas[y:y + img_height, x:x + img_width]
+                if len(pending) >= max_workers * 2:
+                    # デコードが縮小より速い場合に元解像度のフレームがキューに溜まり続けないよう、待ち枚数を制限する
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                future = executor.submit(resize_frame, frame, target_size, tile)
+                pending.add(future)
+                futures.append(future)
+                num_images += 1
+                next_sample += capture_interval
+            frame_count += 1
+            # 進捗バーの更新は毎回ブラウザへの送信を伴うため、全体で約PROGRESS_UPDATES回に間引く
+            if frame_total > 0 and frame_count >= next_progress:
+                progress_bar.progress(min(frame_count / frame_total, 1.0), text="フレームを抽出中...")
+                next_progress = frame_count + progress_step
     cap.release()
+    # ワーカー内で発生した例外はここで送出させる
+    for future in futures:
+        future.result()
 
-    if not images:
+    if num_images == 0:
         st.warning("警告: 1枚も画像をキャプチャできませんでした。")
         return None, 0
 
-    # ★★★ ご希望の「1行40枚」設定 ★★★
-    IMAGES_PER_ROW = 40
-    
-    num_images = len(images)
-    img_width, img_height = images[0].size
-    
     cols = min(num_images, IMAGES_PER_ROW)
     rows = math.ceil(num_images / cols)
-    
-    total_width = cols * img_width
-    total_height = rows * img_height
-    grid_image = Image.new('RGB', (total_width, total_height))
-    
-    for i, img in enumerate(images):
-        col_index = i % cols
-        x = col_index * img_width
-        row_index = i // cols
-        y = row_index * img_height
-        grid_image.paste(img, (x, y))
+    canvas = canvas[:rows * img_height, :cols * img_width]
+
+    return canvas, num_images
+
+
+def sweep_video_cache():
+    """保持期間を過ぎたダウンロード済み動画を削除する (サーバー再起動前に残ったものも含む)"""
+    if not VIDEO_CACHE_DIR.exists():
+        return
+    expire_before = time.time() - VIDEO_CACHE_TTL_SECONDS
+    for entry in VIDEO_CACHE_DIR.iterdir():
+        try:
+            # ダウンロード中の.partファイルは書き込みのたびに更新されるため、中身も含めた最終更新時刻で判定する
+            paths = [entry, *entry.iterdir()] if entry.is_dir() else [entry]
+            if max(path.stat().st_mtime for path in paths) >= expire_before:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry)
+            else:
+                entry.unlink()
+        except FileNotFoundError:
+            # 別のセッションが同時に削除した
+            continue
+
+
+@st.cache_data(show_spinner=False, max_entries=20, ttl=VIDEO_CACHE_TTL_SECONDS)
+def fetch_video(url):
+    """動画をダウンロードしてパスと動画IDを返す (URLごとにキャッシュし、キャプチャ枚数を変えても再ダウンロードしない)"""
+    VIDEO_CACHE_DIR.mkdir(exist_ok=True)
+    sweep_video_cache()
+    # 他のセッションのファイルと干渉しないよう、ダウンロードごとに専用のディレクトリを作る
+    entry_dir = Path(tempfile.mkdtemp(dir=VIDEO_CACHE_DIR))
+    video_path, video_id = download_video_with_library(url, entry_dir)
+    if not (video_path and video_path.exists()):
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        # 失敗した結果はキャッシュしない
+        st.stop()
+    return video_path, video_id
+
 
-    return grid_image, num_images
+# 1枚で数十MBになることもあるJPEGを保持するため、件数と保持期間に上限を設ける
+@st.cache_data(show_spinner=False, max_entries=10, ttl=SHEET_CACHE_TTL_SECONDS)
+def build_contact_sheet(url, capture_per_second):
+    """動画をダウンロードしてコンタクトシートのJPEGを作成する (結果はURLとキャプチャ枚数ごとにキャッシュ)"""
+    video_path, video_id = fetch_video(url)
+    if not video_path.exists():
+        # 保持期間を過ぎて動画ファイルが削除されていた場合はダウンロードし直す
+        fetch_video.clear(url)
+        video_path, video_id = fetch_video(url)
+    st.success(f"STEP 1/2: 動画のダウンロードが完了しました。(ID: {video_id})")
+
+    progress_text = "STEP 2/2: コンタクトシートを作成しています..."
+    my_bar = st.progress(0, text=progress_text)
+
+    contact_sheet_image, image_count = create_contact_sheet_image(video_path, capture_per_second, my_bar)
+    my_bar.progress(1.0, text="作成完了！")
+
+    if contact_sheet_image is None:
+        st.stop()
+
+    # libjpeg-turboのSIMD実装でエンコードする (キャンバスはデコーダ出力のBGR順のまま渡せる)
+    ok, buf = cv2.imencode(".jpg", contact_sheet_image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    if not ok:
+        st.error("エラー: 画像のエンコードに失敗しました。")
+        st.stop()
+    return buf.tobytes(), image_count, video_id
 
 
 # --- ここからWebアプリの見た目と操作を定義 ---
@@ -108,6 +243,13 @@ st.set_page_config(page_title="TikTok コンタクトシート作成ツール",
 st.title("🎬 TikTok コンタクトシート作成ツール")
 st.info("TikTok動画のURLを貼り付けると、画像を連結したコンタクトシートをグリッド形式で作成します。")
 
+# 作成処理が失敗してst.stop()で止まっても表示されるよう、フォームより前にサイドバーへ置く
+with st.sidebar:
+    if st.button("キャッシュをクリア", help="同じURLでも動画をダウンロードし直してコンタクトシートを作り直します。"):
+        # 動画ファイルは他のセッションが使用中の可能性があるため消さず、保持期間後の掃除に任せる
+        st.cache_data.clear()
+        st.info("キャッシュをクリアしました。")
+
 with st.form("input_form"):
     tiktok_url = st.text_input("TikTok動画のURLを貼り付けてください", placeholder="https://www.tiktok.com/@...")
     capture_rate = st.number_input("1秒間にキャプチャする枚数", min_value=1, max_value=30, value=2, step=1)
@@ -117,35 +259,15 @@ if submitted:
     if not tiktok_url:
         st.error("URLを入力してください。")
     else:
-        temp_dir = Path("./temp_video_for_webapp")
-        temp_dir.mkdir(exist_ok=True)
-        
-        video_path, video_id = download_video_with_library(tiktok_url, temp_dir)
-
-        if video_path and video_path.exists():
-            st.success(f"STEP 1/2: 動画のダウンロードが完了しました。(ID: {video_id})")
-            
-            progress_text = "STEP 2/2: コンタクトシートを作成しています..."
-            my_bar = st.progress(0, text=progress_text)
-
-            contact_sheet_image, image_count = create_contact_sheet_image(video_path, capture_rate, my_bar)
-            my_bar.progress(1.0, text="作成完了！")
-
-            if contact_sheet_image:
-                st.success(f"🎉 コンタクトシートが完成しました！ ({image_count}枚の画像を結合)")
-                st.subheader("プレビュー")
-                st.image(contact_sheet_image)
-
-                buf = BytesIO()
-                contact_sheet_image.save(buf, format="JPEG", quality=95)
-                img_bytes = buf.getvalue()
-
-                st.download_button(
-                    label="画像をダウンロード",
-                    data=img_bytes,
-                    file_name=f"contact_sheet_{video_id}_{capture_rate}fps.jpg",
-                    mime="image/jpeg"
-                )
-        
-        if temp_dir.exists():
-            shutil.rmtree(temp_dir)
+        img_bytes, image_count, video_id = build_contact_sheet(tiktok_url, capture_rate)
+
+        st.success(f"🎉 コンタクトシートが完成しました！ ({image_count}枚の画像を結合)")
+        st.subheader("プレビュー")
+        st.image(img_bytes)
+
+        st.download_button(
+            label="画像をダウンロード",
+            data=img_bytes,
+            file_name=f"contact_sheet_{video_id}_{capture_rate}fps.jpg",
+            mime="image/jpeg"
+        )